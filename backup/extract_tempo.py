@@ -1,27 +1,33 @@
 import re
 import os
 import sys
+import shutil
+import tempfile
 from mdx_converter_logic import parse_mus_file
 
-def extract_and_convert_tempo(mus_filepath, verbose=True):
+_RE_TIMEBASE = re.compile(r'(#TIMEBASE\s+\d+)')
+
+def extract_and_convert_tempo(mus_filepath, verbose=True, parsed_data=None):
     """
     MUSファイルからテンポ情報を抽出し、NDP MMLのBPMに変換します
     
     Args:
         mus_filepath: 入力MUSファイルのパス
         verbose: デバッグ情報を表示するか
+        parsed_data: parse_mus_fileでパース済みのデータ（指定時はファイルを読み込まない）
     Returns:
         tuple: (mus_tempo, ndp_bpm, active_tracks)
     """
-    try:
-        with open(mus_filepath, 'r', encoding='utf-8', errors='replace') as f:
-            mus_content = f.read()
-    except Exception as e:
-        print(f"Error reading MUS file: {e}")
-        return None, None, []
-    
-    # MUSファイル内容を解析
-    parsed_data = parse_mus_file(mus_content, verbose=verbose)
+    if parsed_data is None:
+        try:
+            with open(mus_filepath, 'r', encoding='utf-8', errors='replace') as f:
+                mus_content = f.read()
+        except Exception as e:
+            print(f"Error reading MUS file: {e}")
+            return None, None, []
+        
+        # MUSファイル内容を解析
+        parsed_data = parse_mus_file(mus_content, verbose=verbose)
     
     # MUSテンポを取得
     mus_tempo = parsed_data.get('mus_tempo')
@@ -42,6 +48,10 @@ def extract_and_convert_tempo(mus_filepath, verbose=True):
         return mus_tempo, None, []
     
     # アクティブなトラックを特定
+    # mus2ndp.parse_mus_fileのパース結果にはトラック番号の並びが含まれるので、それを使う
+    if 'ndp_track_prefix' in parsed_data:
+        return mus_tempo, bpm, list(parsed_data['ndp_track_prefix'])
+    
     active_tracks = []
     MUS_TO_NDP_TRACK_MAP = {
         'A': '1', 'B': '2', 'C': '3', 'D': '4',
@@ -57,7 +67,7 @@ def extract_and_convert_tempo(mus_filepath, verbose=True):
     
     return mus_tempo, bpm, active_tracks
 
-def insert_tempo_to_mml(mml_filepath, bpm, active_tracks, verbose=True):
+def insert_tempo_to_mml(mml_filepath, bpm, active_tracks, verbose=True, mml_content=None):
     """
     MMLファイルに計算されたテンポ情報を挿入します
     
@@ -66,39 +76,41 @@ def insert_tempo_to_mml(mml_filepath, bpm, active_tracks, verbose=True):
         bpm: 挿入するBPM値
         active_tracks: アクティブなトラック番号のリスト
         verbose: デバッグ情報を表示するか
+        mml_content: 作成済みのMML文字列（指定時はmml_filepathから読み込まずに使用する）
     """
     if not bpm or not active_tracks:
         if verbose:
             print("No BPM or active tracks to insert")
         return False
     
+    # テンポコマンド文字列を作成
+    track_prefix = ''.join(active_tracks)
+    tempo_command = f"{track_prefix} T{bpm}"
+    
     try:
-        # MMLファイルを読み込み
-        with open(mml_filepath, 'r', encoding='utf-8') as f:
-            mml_content = f.read()
+        if mml_content is None:
+            # MMLファイルを1行ずつ一時ファイルにコピーし、#TIMEBASE行の後にテンポコマンドを挿入
+            inserted = _stream_insert_after_timebase(mml_filepath, tempo_command, verbose)
+        else:
+            # #TIMEBASE行の位置を特定
+            timebase_match = _RE_TIMEBASE.search(mml_content)
+            inserted = timebase_match is not None
+            if inserted:
+                if verbose:
+                    print(f"Inserting tempo command: {tempo_command}")
+                
+                # #TIMEBASE行の後にテンポコマンドを挿入して書き込み（文字列全体の連結は行わない）
+                timebase_pos = timebase_match.end()
+                with open(mml_filepath, 'w', encoding='utf-8') as f:
+                    f.write(mml_content[:timebase_pos])
+                    f.write(f"\n{tempo_command}")
+                    f.write(mml_content[timebase_pos:])
         
-        # #TIMEBASE行の位置を特定
-        timebase_match = re.search(r'(#TIMEBASE\s+\d+)', mml_content)
-        if not timebase_match:
+        if not inserted:
             if verbose:
                 print("No #TIMEBASE line found in MML file")
             return False
             
-        # テンポコマンド文字列を作成
-        track_prefix = ''.join(active_tracks)
-        tempo_command = f"{track_prefix} T{bpm}"
-        
-        if verbose:
-            print(f"Inserting tempo command: {tempo_command}")
-        
-        # #TIMEBASE行の後にテンポコマンドを挿入
-        timebase_pos = timebase_match.end()
-        new_mml_content = mml_content[:timebase_pos] + f"\n{tempo_command}" + mml_content[timebase_pos:]
-        
-        # 変更内容をファイルに書き込み
-        with open(mml_filepath, 'w', encoding='utf-8') as f:
-            f.write(new_mml_content)
-            
         if verbose:
             print(f"Successfully updated {mml_filepath} with tempo command")
         return True
@@ -107,6 +119,42 @@ def insert_tempo_to_mml(mml_filepath, bpm, active_tracks, verbose=True):
         print(f"Error updating MML file: {e}")
         return False
 
+def _stream_insert_after_timebase(mml_filepath, tempo_command, verbose=True):
+    """
+    MMLファイルを1行ずつ読み込み、最初の#TIMEBASEの後にテンポコマンドを挿入して書き換えます。
+    
+    Returns:
+        bool: #TIMEBASEが見つかり、ファイルを書き換えた場合はTrue
+    """
+    inserted = False
+    with open(mml_filepath, 'r', encoding='utf-8') as src:
+        # 一時ファイルは元のファイルと同じディレクトリに一意な名前で作成する
+        fd, tmp_filepath = tempfile.mkstemp(dir=os.path.dirname(mml_filepath) or '.', suffix='.tmp')
+        replaced = False
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as dst:
+                for line in src:
+                    if not inserted:
+                        timebase_match = _RE_TIMEBASE.search(line)
+                        if timebase_match:
+                            if verbose:
+                                print(f"Inserting tempo command: {tempo_command}")
+                            timebase_pos = timebase_match.end()
+                            line = f"{line[:timebase_pos]}\n{tempo_command}{line[timebase_pos:]}"
+                            inserted = True
+                    dst.write(line)
+            if inserted:
+                # 元のファイルのパーミッションを引き継いでから置き換える
+                shutil.copymode(mml_filepath, tmp_filepath)
+                src.close()
+                os.replace(tmp_filepath, mml_filepath)
+                replaced = True
+        finally:
+            # 挿入しなかった場合やエラー時は、この呼び出しで作成した一時ファイルを削除する
+            if not replaced:
+                os.remove(tmp_filepath)
+    return inserted
+
 def main():
     # コマンドライン引数の確認
     if len(sys.argv) < 3:
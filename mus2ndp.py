@@ -15,27 +15,69 @@ MUS形式音楽ファイルをNDP互換のMML形式に変換するツール
 import re
 import os
 import sys
+import io
+import shutil
+import logging
+import tempfile
+
+log = logging.getLogger(__name__)
 
 # グローバル定数
 MUS_TO_NDP_TRACK_MAP = {
     'A': '1', 'B': '2', 'C': '3', 'D': '4', 'E': '5', 'F': '6', 'G': '7', 'H': '8'
 }
+# MUS_TO_NDP_TRACK_MAPを ord(トラック文字) - ord('A') で引けるようにしたもの
+_NDP_TRACK_BY_INDEX = tuple(MUS_TO_NDP_TRACK_MAP[c] for c in 'ABCDEFGH')
+# 使用中トラックのビットマスク（'A'=bit0）からテンポコマンド用のトラック番号の並び（例: "123"）への表
+_MASK_TO_PREFIX = tuple(
+    ''.join(ndp_track for i, ndp_track in enumerate(_NDP_TRACK_BY_INDEX) if mask & (1 << i))
+    for mask in range(1 << len(_NDP_TRACK_BY_INDEX))
+)
 
 NDP_TIMEBASE = 48  # NDP MMLのデフォルトタイムベース
 MAX_LINE_LENGTH_MMLE = 80  # MML Editorの1行あたりの最大文字数
+_VALID_TRACK_SET = frozenset('ABCDEFGH')  # MUSのトラック文字
+_DEL_BRACKETS = str.maketrans('', '', '[]')  # []括弧削除用の変換テーブル
+
+# プリコンパイル済みの正規表現
+_RE_HEADER = re.compile(r'#(TITLE|COMPOSER)(.*)', re.IGNORECASE)  # #TITLE / #COMPOSER ヘッダー
+_RE_VOICE_DEF = re.compile(r'(@[^=]*?)\s*=\s*(\{.*\})')  # 音色定義: @ 69={ ... }
+_RE_COMMAND_TRIGGER = re.compile(r'[DpL]')  # D/p/Lコマンドの先頭文字
+_RE_WS = re.compile(r'\s+')
+# 行分割ポイント（音符/休符/オクターブ記号）のうち、検索範囲内で最後のもの
+_RE_BOUNDARY = re.compile(r'.*[abcdefgrABCDEFGR<>]', re.DOTALL)
+_RE_TEMPO = re.compile(r'@\s*t\s*(\d+)')  # テンポ指定: @t220, @t 220, @ t 220
+_RE_INSTR = re.compile(r'@(\d+)')  # トラック固有の楽器指定: @69
+_RE_INSTR_NONEQ = re.compile(r'@\s*\d+(?!\s*=)')  # 音色定義（@NN=）ではない楽器指定
+
+def _skip_ws(text, pos):
+    """
+    text[pos:]の先頭の空白を読み飛ばした位置を返します。
+    """
+    ws_match = _RE_WS.match(text, pos)
+    return ws_match.end() if ws_match else pos
+
+def _mus_to_ndp(track_char):
+    """
+    MUSトラック文字（'A'〜'H'）をNDPトラック番号に変換します。対応しない文字の場合はNoneを返します。
+    """
+    idx = ord(track_char) - 65  # ord('A')
+    return _NDP_TRACK_BY_INDEX[idx] if 0 <= idx < len(_NDP_TRACK_BY_INDEX) else None
 
 def parse_mus_file(content, verbose=False):
     """
     MUSファイルの内容をパースして、トラックデータとメタデータを抽出します。
     
     Args:
-        content: MUSファイルの内容
+        content: MUSファイルの行のイテラブル（開いたファイルオブジェクトなど）、またはMUSファイルの内容の文字列
         verbose: デバッグ情報を表示するかどうか
     Returns:
         dict: タイトル、作曲者、トラックデータなどを含む辞書
     """
-    if verbose:
-        print(f"DEBUG parse_mus_file: Starting with verbose={verbose}")
+    # ループ内で毎回判定するため、デバッグ出力の有無をローカル変数に保持する
+    _dbg = verbose and log.isEnabledFor(logging.DEBUG)
+    if _dbg:
+        log.debug("parse_mus_file: Starting with verbose=%s", verbose)
         
     result = {
         'title': '', 
@@ -48,124 +90,131 @@ def parse_mus_file(content, verbose=False):
     
     current_track = None
     track_data_list_for_current_track = []
-    VALID_MUS_TRACK_CHARS = "ABCDEFGH"
 
-    lines = content.splitlines()
+    # 文字列が渡された場合は行に分割する（ファイルオブジェクトはそのまま1行ずつ読み込む）
+    lines = content.splitlines() if isinstance(content, str) else content
     for i, line_raw in enumerate(lines):
         line_num_for_debug = i + 1
         line_stripped = line_raw.strip()
 
-        if verbose:
-            print(f"DEBUG parse_mus_file: Processing line {line_num_for_debug}: '{line_stripped[:50]}'...")
+        if _dbg:
+            log.debug("parse_mus_file: Processing line %s: '%s'...", line_num_for_debug, line_stripped[:50])
 
         # 空行とコメント行のスキップ処理
         if not line_stripped or line_stripped.startswith(';') or line_stripped.startswith('*'):
-            if verbose:
-                print(f"DEBUG parse_mus_file: Skipping comment/empty line {line_num_for_debug}")
+            if _dbg:
+                log.debug("parse_mus_file: Skipping comment/empty line %s", line_num_for_debug)
             continue
 
-        # タイトルと作曲者の抽出
-        if line_stripped.upper().startswith("#TITLE"):
-            result['title'] = line_stripped[len("#TITLE"):].strip().replace('"', '')
-            if verbose: 
-                print(f"DEBUG parse_mus_file: Found Title: {result['title']}")
-            continue
-            
-        if line_stripped.upper().startswith("#COMPOSER"):
-            result['composer'] = line_stripped[len("#COMPOSER"):].strip().replace('"', '')
-            if verbose: 
-                print(f"DEBUG parse_mus_file: Found Composer: {result['composer']}")
+        # タイトルと作曲者の抽出（大文字小文字を区別しない）
+        header_match = _RE_HEADER.match(line_stripped)
+        if header_match:
+            header_value = header_match.group(2).strip().replace('"', '')
+            if header_match.group(1).upper() == 'TITLE':
+                result['title'] = header_value
+                if _dbg: 
+                    log.debug("parse_mus_file: Found Title: %s", result['title'])
+            else:
+                result['composer'] = header_value
+                if _dbg: 
+                    log.debug("parse_mus_file: Found Composer: %s", result['composer'])
             continue
         
         # 音色定義の処理（例: "@ 69={ ... }"）
-        if line_stripped.startswith('@') and '=' in line_stripped and '{' in line_stripped and '}' in line_stripped:
-            parts = line_stripped.split('=', 1)
-            inst_id_key = parts[0].strip()  # e.g. "@ 69"
-            inst_data_str = parts[1].strip()
-            if inst_data_str.startswith('{') and inst_data_str.endswith('}'):
-                result['voice_definitions'][inst_id_key] = inst_data_str
-                if verbose: 
-                    print(f"DEBUG parse_mus_file: Found Voice Definition for {inst_id_key}")
+        voice_def_match = _RE_VOICE_DEF.fullmatch(line_stripped)
+        if voice_def_match:
+            inst_id_key = voice_def_match.group(1)  # e.g. "@ 69"
+            result['voice_definitions'][inst_id_key] = voice_def_match.group(2)
+            if _dbg: 
+                log.debug("parse_mus_file: Found Voice Definition for %s", inst_id_key)
+            continue
+        if line_stripped[0] == '@' and '=' in line_stripped and '{' in line_stripped and '}' in line_stripped:
+            # 書式が正しくない音色定義行は読み飛ばす
             continue
 
-        # トラックデータ処理
-        line_starts_with_track_char = False
-        potential_track_id = ''
-        if line_stripped and line_stripped[0].isalpha() and line_stripped[0].isupper() and line_stripped[0] in VALID_MUS_TRACK_CHARS:
-            line_starts_with_track_char = True
-            potential_track_id = line_stripped[0]
-
-        if line_starts_with_track_char:
+        # トラックデータ処理（ここまでで空行は除外済みなので先頭文字は必ず存在する）
+        potential_track_id = line_stripped[0]
+        if potential_track_id in _VALID_TRACK_SET:
             data_after_potential_track_id = line_stripped[1:]  # 先頭のトラック文字の後のデータ
             
             # 定義コマンド（@t, @NN）がデータ部分にあるかチェック
             is_definition_command_present = '@t' in data_after_potential_track_id or \
-                                           bool(re.search(r"@\s*\d+(?!\s*=)", data_after_potential_track_id.lstrip()))
+                                           bool(_RE_INSTR_NONEQ.search(data_after_potential_track_id))
 
             if current_track is None or potential_track_id != current_track or is_definition_command_present:
                 # ケース1: 完全に新しいトラック、別のトラック、または現在のトラックの再定義
-                if verbose:
-                    print(f"DEBUG parse_mus_file: Detected new/redefined track: '{line_stripped[:50]}'...")
+                if _dbg:
+                    log.debug("parse_mus_file: Detected new/redefined track: '%s'...", line_stripped[:50])
                     
                 # 以前のトラックデータを保存
                 if current_track is not None and track_data_list_for_current_track:
                     data_to_save = ' '.join(track_data_list_for_current_track).strip()
                     if data_to_save:
                         result['tracks'][current_track] = data_to_save
-                        if verbose:
-                            print(f"DEBUG parse_mus_file: Saved data for track '{current_track}'")
+                        if _dbg:
+                            log.debug("parse_mus_file: Saved data for track '%s'", current_track)
                 
                 # 新しいトラックの処理を開始
                 current_track = potential_track_id
                 track_data_list_for_current_track = []  # リセット
-                if verbose:
-                    print(f"DEBUG parse_mus_file: Starting/redefined track '{current_track}'")
+                if _dbg:
+                    log.debug("parse_mus_file: Starting/redefined track '%s'", current_track)
 
                 # トラック行からテンポと楽器情報を処理
                 processed_data, track_instruments, mus_tempo = preprocess_and_extract_data_from_track_line(
-                    data_after_potential_track_id.lstrip(), 
+                    data_after_potential_track_id, 
                     current_track,
                     result['track_instruments'],
-                    verbose=verbose
+                    verbose=_dbg
                 )
                 
                 # 初めて見つかったテンポを保存
                 if mus_tempo is not None and result['mus_tempo'] is None:
                     result['mus_tempo'] = mus_tempo
-                    if verbose:
-                        print(f"DEBUG parse_mus_file: Stored initial MUS tempo: {result['mus_tempo']}")
+                    if _dbg:
+                        log.debug("parse_mus_file: Stored initial MUS tempo: %s", result['mus_tempo'])
 
                 if processed_data:
                     track_data_list_for_current_track.append(processed_data)
             else:
                 # ケース2: 同じトラック文字で始まるが、再定義ではない継続行
                 processed_data, _, _ = preprocess_and_extract_data_from_track_line(
-                    data_after_potential_track_id.lstrip(),
+                    data_after_potential_track_id,
                     current_track,
                     result['track_instruments'],
-                    verbose=verbose
+                    verbose=_dbg
                 )
                 if processed_data:
                     track_data_list_for_current_track.append(processed_data)
-        elif line_stripped:  # トラック文字以外で始まる非空白行
+        else:  # トラック文字以外で始まる非空白行
             if current_track is not None:  # 現在処理中のトラックがある場合
                 # 直前のトラックデータの続きとして扱う
                 track_data_list_for_current_track.append(line_stripped)
-                if verbose:
-                    print(f"DEBUG parse_mus_file: Appended non-track-prefixed line to track '{current_track}'")
+                if _dbg:
+                    log.debug("parse_mus_file: Appended non-track-prefixed line to track '%s'", current_track)
     
     # 最後のトラックデータを保存
     if current_track is not None and track_data_list_for_current_track:
         data_to_save = ' '.join(track_data_list_for_current_track).strip()
         if data_to_save:
             result['tracks'][current_track] = data_to_save
-            if verbose:
-                print(f"DEBUG parse_mus_file: Saved final track data for '{current_track}'")
+            if _dbg:
+                log.debug("parse_mus_file: Saved final track data for '%s'", current_track)
     
-    if verbose:
-        print(f"DEBUG parse_mus_file: Parsing complete. Found {len(result['tracks'])} tracks")
+    # 出力順のトラック文字（トラック文字は常に大文字で保存されている）
+    result['sorted_track_keys'] = sorted(result['tracks'])
+    
+    # テンポコマンド用のNDPトラック番号の並び（例: "123"）を一度だけ求めておく
+    # トラック文字は'A'〜'H'に限られるため、ビットマスクにして表を引く
+    track_mask = 0
+    for track_char in result['tracks']:
+        track_mask |= 1 << (ord(track_char) - 65)  # ord('A')
+    result['ndp_track_prefix'] = _MASK_TO_PREFIX[track_mask]
+    
+    if _dbg:
+        log.debug("parse_mus_file: Parsing complete. Found %s tracks", len(result['tracks']))
         if result['mus_tempo'] is not None:
-            print(f"DEBUG parse_mus_file: MUS tempo: {result['mus_tempo']}")
+            log.debug("parse_mus_file: MUS tempo: %s", result['mus_tempo'])
     
     return result
 
@@ -182,45 +231,42 @@ def preprocess_and_extract_data_from_track_line(line_content, track_char, track_
         tuple: (処理済みのデータ, 更新された楽器辞書, 抽出されたテンポ)
     """
     if verbose:
-        print(f"DEBUG preprocess_and_extract: Processing track '{track_char}' line data")
+        log.debug("preprocess_and_extract: Processing track '%s' line data", track_char)
         
-    # 先頭の空白を削除
-    line_content_stripped = line_content.lstrip()
+    # 先頭の空白を読み飛ばす（文字列は切り出さず、開始位置だけを進める）
+    start = _skip_ws(line_content, 0)
     
     # 1. トラックのテンポ指定（@tXXX）を抽出して削除
     extracted_tempo = None
     
-    # 複数のテンポパターンを試みる
-    tempo_patterns = [
-        r'@t(\d+)',           # 基本的なパターン: @t220
-        r'@t\s+(\d+)',        # スペース入りパターン: @t 220
-        r'@\s*t\s*(\d+)'      # 任意のスペース: @ t 220
-    ]
-    
-    for pattern in tempo_patterns:
-        tempo_match = re.search(pattern, line_content_stripped)
-        if tempo_match:
-            extracted_tempo = int(tempo_match.group(1))
-            if verbose:
-                print(f"DEBUG preprocess_and_extract: Found tempo @t{extracted_tempo} in track '{track_char}'")
-            
-            # マッチした部分を削除
-            line_content_stripped = line_content_stripped[:tempo_match.start()] + line_content_stripped[tempo_match.end():]
-            line_content_stripped = line_content_stripped.lstrip()
-            break
+    # @t220, @t 220, @ t 220 のいずれの書式も1つのパターンで検出する
+    tempo_match = _RE_TEMPO.search(line_content, start)
+    if tempo_match:
+        extracted_tempo = int(tempo_match.group(1))
+        if verbose:
+            log.debug("preprocess_and_extract: Found tempo @t%s in track '%s'", extracted_tempo, track_char)
+        
+        # マッチした部分を削除
+        if tempo_match.start() == start:
+            # 行頭のテンポ指定（通常のケース）は開始位置を進めるだけでよい
+            start = _skip_ws(line_content, tempo_match.end())
+        else:
+            # 行の途中のテンポ指定は前後を連結する（前半は空白以外で始まるので先頭の空白処理は不要）
+            line_content = line_content[start:tempo_match.start()] + line_content[tempo_match.end():]
+            start = 0
     
     # 2. トラック固有の楽器指定（@NN）を抽出して削除
-    instrument_match = re.match(r'@(\d+)', line_content_stripped)
+    instrument_match = _RE_INSTR.match(line_content, start)
     if instrument_match:
         instrument_id_val = instrument_match.group(1)
         track_instruments_dict[track_char] = f"@{instrument_id_val}"
         if verbose:
-            print(f"DEBUG preprocess_and_extract: Found instrument @{instrument_id_val} for track '{track_char}'")
+            log.debug("preprocess_and_extract: Found instrument @%s for track '%s'", instrument_id_val, track_char)
         
         # マッチした部分を削除
-        line_content_stripped = line_content_stripped[instrument_match.end():].lstrip()
+        start = _skip_ws(line_content, instrument_match.end())
     
-    return line_content_stripped, track_instruments_dict, extracted_tempo
+    return line_content[start:], track_instruments_dict, extracted_tempo
 
 def split_track_data(mml_data, channel_id, max_length=MAX_LINE_LENGTH_MMLE, verbose=False):
     """
@@ -234,41 +280,96 @@ def split_track_data(mml_data, channel_id, max_length=MAX_LINE_LENGTH_MMLE, verb
     Returns:
         list: プレフィックス付きの分割された行のリスト
     """
-    if not mml_data.strip():
+    mml_data_stripped = mml_data.strip()
+    if not mml_data_stripped:
         return []
     
     result_lines = []
-    remaining_data = mml_data.strip()
+    # 残りのデータを切り出さず、元の文字列上の位置だけを進めていく
+    pos = 0
+    data_length = len(mml_data_stripped)
     
-    while remaining_data:
-        if len(remaining_data) <= max_length:
+    while pos < data_length:
+        if data_length - pos <= max_length:
             # 残りのデータが1行に収まる場合
-            result_lines.append(f"{channel_id} {remaining_data}")
+            result_lines.append(f"{channel_id} {mml_data_stripped[pos:]}")
             break
         
         # 適切な分割ポイントを見つける (ノート、休符、オクターブ記号の前)
-        split_index = max_length
-        
-        # 最大長からさかのぼって適切な分割ポイントを探す
-        while split_index > 0:
-            # 次の文字が音符/休符/オクターブ記号の場合、ここで分割する
-            if split_index < len(remaining_data) and remaining_data[split_index] in 'abcdefgrABCDEFGR<>':
-                break
-            split_index -= 1
-        
-        # 適切な分割ポイントが見つからない場合は、最大長で分割
-        if split_index <= 0:
-            split_index = max_length
+        # pos+1〜pos+max_lengthの範囲で最後に現れる音符/休符/オクターブ記号の位置で分割する
+        boundary_match = _RE_BOUNDARY.match(mml_data_stripped, pos + 1, pos + max_length + 1)
+        if boundary_match:
+            split_pos = boundary_match.end() - 1
+        else:
+            # 適切な分割ポイントが見つからない場合は、最大長で分割
+            split_pos = pos + max_length
         
-        # 行を追加し、残りのデータを更新
-        result_lines.append(f"{channel_id} {remaining_data[:split_index]}")
-        remaining_data = remaining_data[split_index:].strip()
+        # 行を追加し、次の行の先頭の空白を読み飛ばす
+        result_lines.append(f"{channel_id} {mml_data_stripped[pos:split_pos]}")
+        pos = _skip_ws(mml_data_stripped, split_pos)
     
     if verbose and len(result_lines) > 1:
-        print(f"DEBUG split_track_data: Split track {channel_id} data into {len(result_lines)} lines")
+        log.debug("split_track_data: Split track %s data into %s lines", channel_id, len(result_lines))
     
     return result_lines
 
+def _unsupported_command_end(text, pos):
+    """
+    text[pos]から始まるDコマンド（D[-+]?数字）またはpコマンド（p数字）の終了位置を返します。
+    コマンドとして成立しない場合はposをそのまま返します。
+    """
+    text_length = len(text)
+    end = pos + 1
+    if text[pos] == 'D' and end < text_length and text[end] in '-+':
+        end += 1
+    digits_start = end
+    while end < text_length and text[end].isdecimal():
+        end += 1
+    return end if end > digits_start else pos
+
+def _scan_mus_commands(track_data):
+    """
+    D/pコマンドの削除とLコマンドの@Lへの変換を1回の走査で行います。
+    Lの直前が単語文字でないこと、直後が空白であることの判定は、D/pコマンドを削除した後の文字列に対して行います。
+    """
+    data_length = len(track_data)
+    chunks = []
+    kept_from = 0  # 出力に残す区間の開始位置
+    last_kept_char = ''  # kept_fromの直前にある、削除されずに残った文字
+    
+    for trigger in _RE_COMMAND_TRIGGER.finditer(track_data):
+        pos = trigger.start()
+        prev_char = track_data[pos - 1] if kept_from < pos else last_kept_char
+        
+        if track_data[pos] != 'L':
+            # D/pコマンドを削除
+            end = _unsupported_command_end(track_data, pos)
+            if end > pos:
+                chunks.append(track_data[kept_from:pos])
+                last_kept_char = prev_char
+                kept_from = end
+            continue
+        
+        # Lコマンドは単語の先頭にあり、空白が続く場合のみ@Lに変換する
+        if prev_char.isalnum() or prev_char == '_':
+            continue
+        next_pos = pos + 1
+        while next_pos < data_length and track_data[next_pos] in 'Dp':
+            end = _unsupported_command_end(track_data, next_pos)
+            if end == next_pos:
+                break
+            next_pos = end
+        if next_pos < data_length and track_data[next_pos].isspace():
+            # 後続の空白は最後の空白の圧縮でまとめられる
+            chunks.append(track_data[kept_from:pos])
+            chunks.append('@')
+            kept_from = pos
+    
+    if not chunks:
+        return track_data
+    chunks.append(track_data[kept_from:])
+    return ''.join(chunks)
+
 def process_mus_commands(track_data, mml_channel_id, verbose=False, is_pdx_mode=False, current_timebase=48):
     """
     MUSコマンドを処理してNDP互換のMML形式に変換します。
@@ -290,60 +391,35 @@ def process_mus_commands(track_data, mml_channel_id, verbose=False, is_pdx_mode=
         str: 変換されたMML形式のトラックデータ
     """
     if verbose:
-        print(f"DEBUG process_mus_commands: Processing track data for channel {mml_channel_id}")
-    
-    # 変換不能なコマンドを削除
-    # Dコマンド（デチューン）を削除 - 例: D-4, D4 など
-    converted_data = re.sub(r'D[-+]?\d+', '', track_data)
-    
-    # pコマンド（パンポット）を削除 - 例: p1, p0 など
-    converted_data = re.sub(r'p\d+', '', converted_data)
+        log.debug("process_mus_commands: Processing track data for channel %s", mml_channel_id)
     
-    # Lコマンドを@Lに変換 (元の[]の代わり)
-    converted_data = re.sub(r'\bL\s+', '@L ', converted_data)
+    # 変換不能なコマンドを削除し、Lコマンドを@Lに変換 (元の[]の代わり)
+    # Dコマンド（デチューン: D-4, D4 など）とpコマンド（パンポット: p1, p0 など）の削除と
+    # Lコマンドの変換は、D/p/Lの出現位置だけをたどる1回の走査で行う
+    converted_data = _scan_mus_commands(track_data)
     
-    # ]コマンドがあれば、それを削除する
-    converted_data = re.sub(r'\]', '', converted_data)
-    
-    # [コマンドがあれば、それも削除する
-    converted_data = re.sub(r'\[', '', converted_data)
+    # []括弧を削除（1文字単位の削除は正規表現よりstr.translateの方が速い）
+    converted_data = converted_data.translate(_DEL_BRACKETS)
     
     # 複数の空白を一つに圧縮
-    converted_data = re.sub(r'\s+', ' ', converted_data)
+    converted_data = _RE_WS.sub(' ', converted_data)
     
     if verbose:
-        print(f"DEBUG process_mus_commands: Removed unsupported commands (D, p)")
-        print(f"DEBUG process_mus_commands: Converted L commands to @L format")
+        log.debug("process_mus_commands: Removed unsupported commands (D, p)")
+        log.debug("process_mus_commands: Converted L commands to @L format")
     
     return converted_data
 
-def convert_mml_file(mus_filepath, conversion_mode="default", note_length_mode="frames", verbose=False):
+def _iter_mml_lines(parsed_data, verbose=False):
     """
-    MUSファイルをMML形式に変換します。
+    パース済みのMUSデータからMML出力の行を順に生成します。
     
     Args:
-        mus_filepath: 入力MUSファイルのパス
-        conversion_mode: 変換モード（デフォルトまたはdirect_8track）
-        note_length_mode: ノート長モード（framesまたはticks）
+        parsed_data: parse_mus_fileの戻り値
         verbose: デバッグ情報を表示するかどうか
     Returns:
-        str: 変換されたMML形式の文字列
+        generator: MML出力の各行（改行なし、空行は空文字列）
     """
-    # conversion_mode の検証（互換性のために残す）
-    if conversion_mode not in ["default", "direct_8track"]:
-        print(f"Warning: conversion_mode '{conversion_mode}' might not be fully applicable for MML output.")
-    
-    try:
-        with open(mus_filepath, 'r', encoding='utf-8', errors='replace') as f:
-            mus_content = f.read()
-    except Exception as e:
-        return f"Error reading MUS file: {e}"
-
-    # MUSファイルの内容をパースする
-    if verbose:
-        print(f"DEBUG convert_mml_file: Parsing MUS file: {mus_filepath}")
-    parsed_data = parse_mus_file(mus_content, verbose=verbose)
-
     title = parsed_data.get('title', "Untitled")
     composer = parsed_data.get('composer', "Unknown")
     mus_tempo = parsed_data.get('mus_tempo')  # 抽出されたMUSテンポ
@@ -352,11 +428,9 @@ def convert_mml_file(mus_filepath, conversion_mode="default", note_length_mode="
     timebase = NDP_TIMEBASE  # デフォルトのタイムベース
 
     # MML出力の基本構造を作成
-    mml_output_parts = [
-        f'#TITLE "{title}"',
-        f'#COMPOSER "{composer}"',
-        f'#TIMEBASE {timebase}',
-    ]
+    yield f'#TITLE "{title}"'
+    yield f'#COMPOSER "{composer}"'
+    yield f'#TIMEBASE {timebase}'
 
     # テンポコマンドの追加（mus_tempoが利用可能な場合）
     # MUSファイルのテンポ情報（@t220など）をNDP MMLのテンポ情報（123 T163など）に変換
@@ -371,75 +445,68 @@ def convert_mml_file(mus_filepath, conversion_mode="default", note_length_mode="
             # テンポコマンド用のアクティブなNDPトラックを特定
             # NDP MMLでは、テンポコマンドは実行されるトラック番号を指定する必要がある
             # 例: 123 T163 （トラック1、2、3がテンポ163で実行される）
-            active_ndp_tracks_for_tempo = []
-            
-            if parsed_data.get('tracks'):
-                # 解析されたMUSファイルから使用中の全トラックを取得
-                sorted_mus_keys_for_tempo = sorted(parsed_data['tracks'].keys())
-                for mus_key in sorted_mus_keys_for_tempo:
-                    # MUSトラック名（A、B、Cなど）をNDPトラック番号（1、2、3など）に変換
-                    ndp_track_num = MUS_TO_NDP_TRACK_MAP.get(mus_key.upper())
-                    if ndp_track_num:
-                        active_ndp_tracks_for_tempo.append(ndp_track_num)
-                
-                if active_ndp_tracks_for_tempo:
-                    # トラック番号を数値順にソートして結合（例: ["1", "2", "3"] -> "123"）
-                    active_ndp_tracks_for_tempo.sort(key=int) 
-                    tempo_track_prefix = "".join(active_ndp_tracks_for_tempo)
-                    # テンポコマンドをMML出力に追加（例: "123 T163"）
-                    mml_output_parts.append(f'{tempo_track_prefix} T{bpm}')
-                    if verbose:
-                        print(f"DEBUG convert_mml_file: Added tempo command: {tempo_track_prefix} T{bpm}")
+            # トラック番号の並びはparse_mus_fileで求めたものをそのまま使う
+            tempo_track_prefix = parsed_data.get('ndp_track_prefix')
+            if tempo_track_prefix:
+                # テンポコマンドをMML出力に追加（例: "123 T163"）
+                yield f'{tempo_track_prefix} T{bpm}'
+                if verbose:
+                    log.debug("convert_mml_file: Added tempo command: %s T%s", tempo_track_prefix, bpm)
         except ZeroDivisionError:
             print(f"Warning: MUS tempo {mus_tempo} resulted in division by zero. Tempo command skipped.")
         except Exception as e:
             print(f"Warning: Error calculating BPM from MUS tempo {mus_tempo}: {e}. Tempo command skipped.")
 
     # ヘッダーの後に空行を追加
-    mml_output_parts.append('')  
+    yield ''
 
     # 音色定義の追加（コメントとして）
     if parsed_data.get('voice_definitions'): 
-        mml_output_parts.append("// Voice Definitions (from MUS @ NN={...})")
+        yield "// Voice Definitions (from MUS @ NN={...})"
         for voice_id, voice_data_str in sorted(parsed_data['voice_definitions'].items()):
             # 音色データ文字列のクリーンアップ
             voice_comment = str(voice_data_str).replace('\n', ' ').replace('\r', ' ').replace('\t', ' ')
-            voice_comment = re.sub(r'\s+', ' ', voice_comment).strip()
-            mml_output_parts.append(f"// {voice_id} = {voice_comment}")
-        mml_output_parts.append('')  # 音色定義の後に空行
+            voice_comment = _RE_WS.sub(' ', voice_comment).strip()
+            yield f"// {voice_id} = {voice_comment}"
+        yield ''  # 音色定義の後に空行
     
     # トラック固有の楽器指定があれば追加
     if parsed_data.get('track_instruments'):
         has_simple_track_instruments = any(val for val in parsed_data['track_instruments'].values())
         if has_simple_track_instruments:
-            mml_output_parts.append("// Track-specific Instrument Assignments (from MUS Track @NN)")
+            yield "// Track-specific Instrument Assignments (from MUS Track @NN)"
             for track_char, inst_id_str in sorted(parsed_data['track_instruments'].items()):
                 if inst_id_str:  # 楽器が割り当てられている場合
-                     mml_output_parts.append(f"// Track {track_char}: {inst_id_str}")
-            mml_output_parts.append('')  # 空行
+                     yield f"// Track {track_char}: {inst_id_str}"
+            yield ''  # 空行
 
     # トラックデータの処理
-    processed_tracks_output = []
-    # 一貫したMML出力順序のためにMUSトラック文字でソート
-    sorted_mus_track_keys = sorted(parsed_data.get('tracks', {}).keys())
+    # 一貫したMML出力順序のためにMUSトラック文字でソート（parse_mus_fileでソート済み）
+    sorted_mus_track_keys = parsed_data.get('sorted_track_keys', [])
     
     if verbose:
-        print(f"DEBUG convert_mml_file: Processing tracks: {sorted_mus_track_keys}")
+        log.debug("convert_mml_file: Processing tracks: %s", sorted_mus_track_keys)
+    
+    # ループ内で繰り返し参照する辞書・関数をローカル変数に束縛しておく
+    _tracks = parsed_data.get('tracks', {})
+    _to_ndp = _mus_to_ndp
+    _process = process_mus_commands
+    _split = split_track_data
     
     for mus_track_key in sorted_mus_track_keys:
-        full_mus_track_data = parsed_data['tracks'][mus_track_key]
-        mml_channel_id = MUS_TO_NDP_TRACK_MAP.get(mus_track_key.upper())
+        full_mus_track_data = _tracks[mus_track_key]
+        mml_channel_id = _to_ndp(mus_track_key)
         
         if not mml_channel_id:
             # MMLチャンネルマッピングがないトラックはスキップ
             if verbose:
-                print(f"DEBUG convert_mml_file: Skipping track '{mus_track_key}' (no channel mapping)")
+                log.debug("convert_mml_file: Skipping track '%s' (no channel mapping)", mus_track_key)
             continue
 
-        processed_tracks_output.append(f"// トラック {mus_track_key.upper()} (チャンネル {mml_channel_id})")
+        yield f"// トラック {mus_track_key} (チャンネル {mml_channel_id})"
         
         # トラックデータをMML形式に変換
-        single_mml_track_string = process_mus_commands(
+        single_mml_track_string = _process(
             full_mus_track_data, 
             mml_channel_id, 
             verbose=verbose, 
@@ -448,22 +515,88 @@ def convert_mml_file(mus_filepath, conversion_mode="default", note_length_mode="
         )
         
         # 長いMML文字列を行に分割
-        mml_track_lines_split = split_track_data(
+        mml_track_lines_split = _split(
             single_mml_track_string, 
             mml_channel_id, 
             max_length=MAX_LINE_LENGTH_MMLE, 
             verbose=verbose
         )
         
-        processed_tracks_output.extend(mml_track_lines_split)
-        processed_tracks_output.append('')  # 各トラックのMML内容の後に空行を追加
+        yield from mml_track_lines_split
+        yield ''  # 各トラックのMML内容の後に空行を追加
+
+def _write_mml_lines(lines, output):
+    """
+    MML出力の行をファイルオブジェクトに書き込みます。
+    "\n".join(lines).strip() + "\n" と同じ内容になるよう、末尾の空行は書き込みません。
+    """
+    pending_blank_lines = 0
+    for line in lines:
+        if not line:
+            # 空行は後に内容のある行が続く場合のみ書き込む
+            pending_blank_lines += 1
+            continue
+        if pending_blank_lines:
+            output.write('\n' * pending_blank_lines)
+            pending_blank_lines = 0
+        output.write(line)
+        output.write('\n')
+
+def convert_mml_file(mus_filepath, conversion_mode="default", note_length_mode="frames", verbose=False, output=None):
+    """
+    MUSファイルをMML形式に変換します。
     
-    # 最終的なMML出力を構築
-    mml_output_parts.extend(processed_tracks_output)
+    Args:
+        mus_filepath: 入力MUSファイルのパス
+        conversion_mode: 変換モード（デフォルトまたはdirect_8track）
+        note_length_mode: ノート長モード（framesまたはticks）
+        verbose: デバッグ情報を表示するかどうか
+        output: 変換結果を書き込むファイルオブジェクト（省略時は文字列として返す）
+    Returns:
+        str: 変換されたMML形式の文字列。MUSファイルを読み込めない場合はエラーメッセージ。
+             outputを指定した場合は常にNone
+    Raises:
+        OSError: outputを指定していて、MUSファイルを読み込めない場合
+    """
+    # conversion_mode の検証（互換性のために残す）
+    if conversion_mode not in ["default", "direct_8track"]:
+        print(f"Warning: conversion_mode '{conversion_mode}' might not be fully applicable for MML output.")
     
-    final_mml_content = "\n".join(mml_output_parts).strip()
-    # ファイルが空でも末尾に改行を確保
-    return final_mml_content + "\n" if final_mml_content else "\n"
+    # MUSファイルを1行ずつ読み込みながらパースする（ファイル全体を一度にメモリに読み込まない）
+    if verbose:
+        log.debug("convert_mml_file: Parsing MUS file: %s", mus_filepath)
+    # 読み込みエラー（OSError）のみを扱い、パース処理の例外は呼び出し元に伝える
+    try:
+        with open(mus_filepath, 'r', encoding='utf-8', errors='replace') as f:
+            parsed_data = parse_mus_file(f, verbose=verbose)
+    except OSError as e:
+        if output is not None:
+            # 出力先にはエラーメッセージを書き込まず、呼び出し元に例外を伝える
+            raise
+        return f"Error reading MUS file: {e}"
+
+    if output is None:
+        # 出力先が指定されていない場合は文字列として返す
+        buffer = io.StringIO()
+        _write_mml_lines(_iter_mml_lines(parsed_data, verbose=verbose), buffer)
+        return buffer.getvalue()
+    
+    # 各行をそのまま出力先に書き込む（出力全体をメモリ上で組み立てない）
+    _write_mml_lines(_iter_mml_lines(parsed_data, verbose=verbose), output)
+    return None
+
+def _apply_output_mode(tmp_path, output_path):
+    """
+    一時ファイルのパーミッションを、出力ファイルを直接open()した場合と同じにします。
+    既存の出力ファイルがあればそのパーミッションを引き継ぎます。
+    """
+    if os.path.exists(output_path):
+        shutil.copymode(output_path, tmp_path)
+    else:
+        # mkstempは0600で作成するため、umaskに従った通常の権限に戻す
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_path, 0o666 & ~umask)
 
 def parse_arguments():
     """
@@ -501,6 +634,8 @@ def main():
         output_path = f"{file_name}.mml"
     
     if args.verbose:
+        # デバッグ出力はloggingで標準エラー出力に表示する
+        logging.basicConfig(level=logging.DEBUG, format='%(levelname)s %(message)s')
         print(f"変換中: {args.input_file} -> {output_path}")
         print(f"モード: {args.mode}, ノート長モード: {args.length_mode}")
     
@@ -518,17 +653,23 @@ def main():
             sys.exit(1)
     
     try:
-        # ファイルを変換
-        result = convert_mml_file(
-            args.input_file,
-            conversion_mode=args.mode,
-            note_length_mode=args.length_mode,
-            verbose=args.verbose
-        )
-        
-        # 結果をファイルに保存
-        with open(output_path, 'w', encoding='utf-8') as f:
-            f.write(result)
+        # 出力ディレクトリ内の一時ファイルに変換結果を書き込み、成功した場合のみ出力ファイルと置き換える
+        # （入力と出力が同じファイルでも読み込み前に切り詰められず、失敗時に既存の出力も壊さない）
+        fd, tmp_path = tempfile.mkstemp(dir=output_dir or '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                convert_mml_file(
+                    args.input_file,
+                    conversion_mode=args.mode,
+                    note_length_mode=args.length_mode,
+                    verbose=args.verbose,
+                    output=f
+                )
+            _apply_output_mode(tmp_path, output_path)
+            os.replace(tmp_path, output_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
         
         if args.verbose:
             print(f"変換が完了しました: {output_path}")